@@ -4,6 +4,7 @@
 LSP session client for testing.
 """
 
+import asyncio
 import os
 import subprocess
 import sys
@@ -148,6 +149,12 @@ class LspSession(MethodDispatcher):
         fut = self._send_request("textDocument/codeAction", params=code_action_params)
         return fut.result()
 
+    def text_document_code_action_async(self, code_action_params):
+        """Sends text document code actions request to LSP server, returning an
+        awaitable for the response."""
+        fut = self._send_request("textDocument/codeAction", params=code_action_params)
+        return asyncio.wrap_future(fut)
+
     def code_action_resolve(self, code_action_resolve_params):
         """Sends text document code actions resolve request to LSP server."""
         fut = self._send_request(
@@ -159,6 +166,34 @@ class LspSession(MethodDispatcher):
         """Set custom LS notification handler."""
         self._notification_callbacks[notification_name] = callback
 
+    def set_notification_future(self, notification_name, predicate=None):
+        """Set LS notification handler that resolves the returned asyncio future
+        with the first notification params accepted by `predicate`. The
+        previous handler is put back once the future is resolved or cancelled."""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        previous = self._notification_callbacks.get(notification_name)
+
+        def _restore(_fut=None):
+            if self._notification_callbacks.get(notification_name) is _callback:
+                if previous is None:
+                    self._notification_callbacks.pop(notification_name, None)
+                else:
+                    self._notification_callbacks[notification_name] = previous
+
+        def _resolve(params):
+            if not fut.done():
+                fut.set_result(params)
+
+        def _callback(params):
+            if predicate is None or predicate(params):
+                _restore()
+                loop.call_soon_threadsafe(_resolve, params)
+
+        self.set_notification_callback(notification_name, _callback)
+        fut.add_done_callback(_restore)
+        return fut
+
     def get_notification_callback(self, notification_name):
         """Gets callback if set or default callback for a given LS
         notification."""
@@ -4,6 +4,7 @@
 Utility functions for use with tests.
 """
 import contextlib
+import functools
 import json
 import os
 import pathlib
@@ -20,6 +21,7 @@ def normalizecase(path: str) -> str:
     return path
 
 
+@functools.lru_cache(maxsize=None)
 def as_uri(path: str) -> str:
     """Return 'file' uri as string."""
     return normalizecase(pathlib.Path(path).as_uri())
@@ -39,8 +41,10 @@ def python_file(contents: str, root: pathlib.Path, ext: str = ".py"):
         os.unlink(str(fullpath))
 
 
+@functools.lru_cache(maxsize=None)
 def get_server_info_defaults():
-    """Returns server info from package.json"""
+    """Returns server info from package.json. The result is cached and shared
+    between callers, so it must not be modified."""
     package_json_path = PROJECT_ROOT / "package.json"
     package_json = json.loads(package_json_path.read_text())
     return package_json["serverInfo"]
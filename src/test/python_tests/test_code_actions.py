@@ -1,289 +1,199 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 """
-Test for code actions over LSP.
+Test for code actions, in-process and over LSP.
 """
 
+import asyncio
+import importlib.util
 import os
-from threading import Event
+import sys
 
+import async_timeout
 import pytest
-from hamcrest import assert_that, is_
 
 from .lsp_test_client import constants, session, utils
 
 TEST_FILE_PATH = constants.TEST_DATA / "sample1" / "sample.py"
 TEST_FILE_URI = utils.as_uri(str(TEST_FILE_PATH))
 LINTER = utils.get_server_info_defaults()["name"]
-TIMEOUT = 10  # 10 seconds
-
-
-@pytest.mark.parametrize(
-    ("code", "contents", "command"),
-    [
-        (
-            "E201",
-            "print ( 'Open parentheses should not have any space before or after them.')",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E202",
-            "print('Closing parentheses should not have any whitespace before them.' )",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E203",
-            "with open('file.dat') as f :\n\tcontents = f.read()",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E211",
-            "with open ('file.dat') as f:\n\tcontents = f.read()",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E221",
-            "doubled = 10  * 2",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E222",
-            "doubled = 10 *  2",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E223",
-            "a\t= 1",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E224",
-            "a =\t1",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E225",
-            "a=1",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E226",
-            "a = 1+2",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E226",
-            "x = 128<<1",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E228",
-            "remainder = 10%2",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E231",
-            "my_tuple = 1,2,3",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E241",
-            "x = [1,   2]",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E251",
-            "def func(key1 = 'val1', key2 = 'val2'):\n\treturn key1, key2",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E242",
-            "a,	b = 1, 2",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E261",
-            "a = 1 # This comment needs an extra space",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E262",
-            "a = 1  #This comment needs a space",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E265",
-            "#This comment needs a space",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E266",
-            "## There should be only one leading # for a block comment.",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E271",
-            "from collections import    (namedtuple, defaultdict)",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E272",
-            "from collections import (namedtuple, defaultdict)     ",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E273",
-            "x = 1 in\t[1, 2, 3]",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E274",
-            "x = 1\tin [1, 2, 3]",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-        (
-            "E275",
-            "from collections import(namedtuple, defaultdict)",
-            {
-                "title": f"{LINTER}: Run document formatting",
-                "command": "editor.action.formatDocument",
-            },
-        ),
-    ],
-)
-def test_command_code_action(code, contents, command):
-    """Tests for code actions which run a command."""
-
-    actual = []
-    with utils.python_file(contents, TEST_FILE_PATH.parent) as temp_file:
+TIMEOUT = 2  # 2 seconds
+
+
+@pytest.fixture(scope="module")
+def lsp_server():
+    """Server module imported in-process, with an empty workspace. Importing
+    it prepends the bundled paths to sys.path, so that is restored after."""
+    saved_path = sys.path[:]
+    spec = importlib.util.spec_from_file_location(
+        "lsp_server", constants.PROJECT_ROOT / "bundled" / "tool" / "lsp_server.py"
+    )
+    module = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(module)
+        # initialize is never sent in-process, so seed the workspace it would create.
+        module.LSP_SERVER.lsp.workspace = module.workspace.Workspace(None)
+        yield module
+    finally:
+        sys.path[:] = saved_path
+
+
+@pytest.fixture(scope="module")
+def ls_session():
+    """LSP session shared by the tests in this module, one per xdist worker."""
+    with session.LspSession() as shared_session:
+        shared_session.initialize()
+        yield shared_session
+
+
+@pytest.fixture(scope="module")
+def document(ls_session):
+    """Python file opened once in the shared LSP session. Tests replace its
+    contents instead of creating and opening a new file each time."""
+    with utils.python_file("", TEST_FILE_PATH.parent) as temp_file:
         uri = utils.as_uri(os.fspath(temp_file))
-        with session.LspSession() as ls_session:
-            ls_session.initialize()
-
-            done = Event()
-
-            def _handler(params):
-                nonlocal actual
-                actual = params
-                done.set()
-
-            ls_session.set_notification_callback(session.PUBLISH_DIAGNOSTICS, _handler)
-
-            ls_session.notify_did_open(
-                {
-                    "textDocument": {
-                        "uri": uri,
-                        "languageId": "python",
-                        "version": 1,
-                        "text": contents,
-                    }
-                }
-            )
-
-            # wait for some time to receive all notifications
-            done.wait(TIMEOUT)
-
-            diagnostics = [
-                {
-                    "range": {
-                        "start": {"line": 0, "character": 0},
-                        "end": {"line": 1, "character": 0},
-                    },
-                    "message": "",
-                    "severity": 1,
-                    "code": code,
-                    "source": LINTER,
-                }
-            ]
-
-            actual_code_actions = ls_session.text_document_code_action(
-                {
-                    "textDocument": {"uri": uri},
-                    "range": {
-                        "start": {"line": 0, "character": 0},
-                        "end": {"line": 1, "character": 0},
-                    },
-                    "context": {"diagnostics": diagnostics},
+        ls_session.notify_did_open(
+            {
+                "textDocument": {
+                    "uri": uri,
+                    "languageId": "python",
+                    "version": 1,
+                    "text": "",
                 }
-            )
-
-            expected = {
-                "title": command["title"],
-                "kind": "quickfix",
-                "diagnostics": diagnostics,
-                "command": command,
             }
+        )
+        yield {"path": temp_file, "uri": uri, "version": 1}
+        ls_session.notify_did_close({"textDocument": {"uri": uri}})
+
+
+# Fields shared by the diagnostics sent with every code action request.
+_DIAG_TEMPLATE = {"message": "", "severity": 1, "source": LINTER}
+
+FORMAT_CMD = {
+    "title": f"{LINTER}: Run document formatting",
+    "command": "editor.action.formatDocument",
+}
+
+# Every code fixed by running document formatting, tested in-process.
+FORMAT_CODES = [
+    "E201",
+    "E202",
+    "E203",
+    "E211",
+    "E221",
+    "E222",
+    "E223",
+    "E224",
+    "E225",
+    "E226",
+    "E227",
+    "E228",
+    "E231",
+    "E241",
+    "E251",
+    "E242",
+    "E261",
+    "E262",
+    "E265",
+    "E266",
+    "E271",
+    "E272",
+    "E273",
+    "E274",
+    "E275",
+]
+
+# Code linted over LSP as a smoke test, and contents that raise it. Use a code
+# that the repository's .flake8 does not ignore, or the test times out.
+SMOKE_CODE = "E201"
+SMOKE_CONTENTS = (
+    "print ( 'Open parentheses should not have any space before or after them.')\n"
+)
 
-        assert_that(actual_code_actions, is_([expected]))
+# Range of the diagnostic sent with every code action request.
+_LINE_RANGE = {
+    "start": {"line": 0, "character": 0},
+    "end": {"line": 1, "character": 0},
+}
+
+
+def _format_request(uri, code):
+    """Returns the code action request for a `code` diagnostic on the first
+    line of `uri`, and the code action expected in response."""
+    diagnostics = [{**_DIAG_TEMPLATE, "range": _LINE_RANGE, "code": code}]
+    request = {
+        "textDocument": {"uri": uri},
+        "range": _LINE_RANGE,
+        "context": {"diagnostics": diagnostics},
+    }
+    expected_action = {
+        "title": FORMAT_CMD["title"],
+        "kind": "quickfix",
+        "diagnostics": diagnostics,
+        "command": FORMAT_CMD,
+    }
+    return request, expected_action
+
+
+def _update_document(ls_session, document, text, code):
+    """Replaces the contents of `document` with `text` and returns a future
+    resolved once diagnostics reporting `code` are published."""
+    uri = document["uri"]
+    document["version"] += 1
+
+    # Ignore notifications for other documents or older contents, and wait
+    # until the linter reports the expected code.
+    linted = ls_session.set_notification_future(
+        session.PUBLISH_DIAGNOSTICS,
+        lambda params: params["uri"] == uri
+        and code in {d.get("code") for d in params.get("diagnostics", [])},
+    )
+
+    # The server lints the file on disk when it is saved.
+    document["path"].write_text(text)
+    ls_session.notify_did_change(
+        {
+            "textDocument": {"uri": uri, "version": document["version"]},
+            "contentChanges": [{"text": text}],
+        }
+    )
+    ls_session.notify_did_save({"textDocument": {"uri": uri}})
+    return linted
+
+
+@pytest.mark.parametrize("code", FORMAT_CODES)
+def test_command_code_action(lsp_server, code):
+    """Tests for code actions which run a command, calling the server's
+    handler in-process."""
+    # lsprotocol is importable once the server has added its bundled libs.
+    from lsprotocol import converters
+
+    converter = converters.get_converter()
+    request, expected_action = _format_request(TEST_FILE_URI, code)
+
+    params = converter.structure(request, lsp_server.lsp.CodeActionParams)
+    actual = converter.unstructure(lsp_server.code_action(params))
+
+    assert actual == [expected_action]
+
+
+@pytest.mark.asyncio
+async def test_command_code_action_over_lsp(ls_session, document):
+    """Smoke test for code actions which run a command, over a real LSP
+    session to guard the wire format."""
+    linted = _update_document(ls_session, document, SMOKE_CONTENTS, SMOKE_CODE)
+    # Build the request while the server is linting the document.
+    request, expected_action = _format_request(document["uri"], SMOKE_CODE)
+
+    try:
+        async with async_timeout.timeout(TIMEOUT):
+            await linted
+    except asyncio.TimeoutError:
+        pytest.fail(f"diagnostics for {SMOKE_CODE} not published within {TIMEOUT}s")
+
+    # Cancelling the pending request on timeout sends $/cancelRequest, so
+    # the server drops it instead of working through a stale queue.
+    async with async_timeout.timeout(TIMEOUT):
+        actual = await ls_session.text_document_code_action_async(request)
+
+    assert actual == [expected_action]